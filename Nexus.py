@@ -7,36 +7,66 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
 import argparse
+import errno
+import json
+import mmap
+import os
+import queue
+import select
 import struct
+import sys
+import threading
+import time
 import serial
+from concurrent.futures import ThreadPoolExecutor
 from serial.tools.list_ports import comports as availablePorts
 from pathlib import Path
-from math import ceil
 
 
 class Nexus:
     NXEOL = b"\xff\xff\xff"
     NXACK = b"\x05"
     NXALL = b"\x08\x00\x00\x00\x00"
+    NXBLOCK = 4096 # Nextion acknowledges every 4096 bytes of upload data.
+    CACHE   = ".nexus_cache.json" # In the home directory; port and speed of the last successful connection.
+    # Most screens run at their factory default of 9600baud/s or at 115200baud/s, so try these first.
+    SPEEDS  = (9600, 115200, 921600, 2400, 4800, 19200, 31250, 38400, 57600, 74880, 230400, 250000, 256000, 460800, 500000, 512000)
 
-    def __init__(self, port="", uploadSpeed=0, connectSpeed=0, connect=True):
+    def __init__(self, port="", uploadSpeed=0, connectSpeed=0, connect=True, blockSize=NXBLOCK, window=1,
+                 ports=None, speculative=False):
+        if blockSize <= 0 or blockSize % self.NXBLOCK:
+            raise Exception("Block size must be a positive multiple of {} (got {}).".format(self.NXBLOCK, blockSize))
+        if window < 1:
+            raise Exception("Window must be at least 1 (got {}).".format(window))
         self.uploadSpeed  = uploadSpeed
         self.connectSpeed = connectSpeed
+        self.blockSize    = blockSize
+        self.window       = max(window, blockSize // self.NXBLOCK) # A single write must fit into the window.
+        self.speculative  = speculative
+        self.useSendfile  = False
         self.connected    = False
         self.touch        = None
         self.address      = 0
+        self.addressPrefix = b""
         self.model        = ""
         self.fwVersion    = -1
         self.mcuCode      = -1
         self.serialNum    = ""
         self.flashSize    = -1
-        self.ports        = [p.name for p in availablePorts()]
+        # Enumerating the ports is expensive; skip it if the caller already did or if there's only one port to use.
+        if ports is None:
+            ports = [port] if port else [p.name for p in availablePorts()]
+        self.ports        = list(ports)
+        self.cache        = self.loadCache()
+        if not port and self.cache.get("port") in self.ports:
+            port = self.cache["port"]
         if port:
             if port not in self.ports:
                 raise Exception("Specified port not available ({} not in {})".format(port, self.ports))
             else:
                 self.ports.remove(port)
                 self.ports.insert(0, port)
+        self.preferredPort = port
 
         self.ser  = serial.Serial()
         if connect:
@@ -44,137 +74,327 @@ class Nexus:
                 raise Exception("Cannot connect to device.")
 
     def connect(self):
-        defaultSpeeds = [2400, 4800, 9600, 19200, 31250, 38400, 57600, 74880, 115200, 230400, 250000, 256000, 460800, 500000, 512000, 921600]
-        if self.connectSpeed:
-            if self.connectSpeed in defaultSpeeds:
-                defaultSpeeds.remove(self.connectSpeed)
-            defaultSpeeds.insert(0, self.connectSpeed)
-
-        for port in self.ports:
-            print("Scanning port " + port)
-            for speed in defaultSpeeds:
-                print("  at {}baud/s... ".format(speed), end="")
-                self.ser.close()
-                self.ser.port = port
-                self.ser.baudrate = speed
-                self.ser.timeout  = 1000/speed + 0.030
-                try:
-                    self.ser.open()
-                except:
-                    break
-                self.ser.reset_input_buffer()
-                self.ser.write(b"DRAKJHSUYDGBNCJHGJKSHBDN\xff\xff\xffconnect\xff\xff\xff\xff\xffconnect\xff\xff\xff")
-                data = b""
-                available = -1
-                while available != len(data):
-                    available = self.ser.in_waiting
-                    newData = self.ser.read_until(expected=self.NXEOL)
-                    if newData:
-                        data = newData
-                    else:
-                        break
-                if not data.startswith(b"comok"):
-                    print("Failed.")
-                    continue
-                self.ser.write(self.NXEOL)
-                self.ser.read(42)
-                self.connected=True
-                data = data.lstrip(b"comok ").rstrip(self.NXEOL).split(b",")
-                data[1] = data[1].split(b"-")[1] # discard reserved part of argument 1
-                self.touch     = bool(int(data[0]))
-                self.address   = int(data[1])
-                self.model     = data[2].decode("ascii")
-                self.fwVersion = int(data[3])
-                self.mcuCode   = int(data[4])
-                self.serialNum = data[5].decode("ascii")
-                self.flashSize = int(data[6])
-                self.port         = port
-                self.connectSpeed = speed
-                if not self.model:
-                    raise Exception("Invalid model! Data: {}".format(data))
-                if not self.uploadSpeed:
-                    self.uploadSpeed = self.connectSpeed
-                print("Success.")
-                return True
-
-        return False
+        # The preferred speed and the speed of the last successful connection go before the default ones.
+        preferred = [s for s in (self.connectSpeed, self.cache.get("speed")) if isinstance(s, int) and s > 0]
+        preferred = list(dict.fromkeys(preferred))
+        speeds    = preferred + [s for s in self.SPEEDS if s not in preferred]
+
+        # The requested (or last used) port is probed on its own; the other ports are only touched if it fails.
+        result = None
+        ports  = self.ports
+        if self.preferredPort:
+            print("Scanning port " + self.preferredPort)
+            result = self.probe(self.preferredPort, speeds, lambda: False)
+            ports  = [port for port in self.ports if port != self.preferredPort]
+        if not result and ports:
+            result = self.scan(ports, speeds)
+        if not result:
+            return False
+
+        self.ser.close()
+        self.ser, speed, data = result
+        self.connected=True
+        # Slice off the literal prefix and terminator; lstrip/rstrip would strip any of their characters.
+        data = data[len(b"comok "):-len(self.NXEOL)].split(b",")
+        data[1] = data[1].split(b"-")[1] # discard reserved part of argument 1
+        self.touch     = bool(int(data[0]))
+        self.address   = int(data[1])
+        self.addressPrefix = struct.pack("<H", self.address) if self.address else b""
+        self.model     = data[2].decode("ascii")
+        self.fwVersion = int(data[3])
+        self.mcuCode   = int(data[4])
+        self.serialNum = data[5].decode("ascii")
+        self.flashSize = int(data[6])
+        self.port         = self.ser.port
+        self.connectSpeed = speed
+        if not self.model:
+            raise Exception("Invalid model! Data: {}".format(data))
+        if not self.uploadSpeed:
+            self.uploadSpeed = self.connectSpeed
+        print("Connected to {} at {}baud/s.".format(self.port, speed))
+        self.cache = {"port": self.port, "speed": speed}
+        self.saveCache()
+        return True
+
+    def loadCache(self):
+        try:
+            with open(Path.home() / self.CACHE) as f:
+                cache = json.load(f)
+        except (OSError, RuntimeError, ValueError): # RuntimeError: home directory can't be determined.
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def saveCache(self):
+        # The cache only speeds up the next connection; failing to write it is not an error.
+        try:
+            with open(Path.home() / self.CACHE, "w") as f:
+                json.dump(self.cache, f)
+        except (OSError, RuntimeError):
+            pass
+
+    def scan(self, ports, speeds):
+        # Probes on different ports are independent, hence scan all of them at once. If several ports answer, the
+        # first one in ports wins; as soon as a port found a device the probes of all ports after it are cancelled.
+        print("Scanning port(s) " + ", ".join(ports))
+        winner = [len(ports)]
+        lock   = threading.Lock()
+
+        def scanPort(index, port):
+            result = self.probe(port, speeds, lambda: winner[0] < index)
+            if result:
+                with lock:
+                    winner[0] = min(winner[0], index)
+            return result
+
+        with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+            probes = [pool.submit(scanPort, index, port) for index, port in enumerate(ports)]
+
+        # All probes have finished here. Keep the winner open and close every other port, all of them if any
+        # probe failed.
+        result = None
+        try:
+            for probe in probes:
+                if probe.result() and not result:
+                    result = probe.result()
+        except BaseException:
+            result = None
+            raise
+        finally:
+            for probe in probes:
+                if not probe.exception() and probe.result() and probe.result() is not result:
+                    probe.result()[0].close()
+        return result
+
+    def probe(self, port, speeds, cancelled):
+        # Returns (serial port, speed, reply) for the first speed at which a device answers on port, None otherwise
+        # or once cancelled() returns True.
+        ser = serial.Serial()
+        ser.port = port
+        for speed in speeds:
+            if cancelled():
+                break
+            ser.close()
+            ser.baudrate = speed
+            ser.timeout  = 1280/speed + 0.030 # Enough for a 128 bytes reply (10 bits each) plus processing.
+            try:
+                ser.open()
+            except:
+                break
+            ser.reset_input_buffer()
+            ser.write(b"DRAKJHSUYDGBNCJHGJKSHBDN\xff\xff\xffconnect\xff\xff\xff\xff\xffconnect\xff\xff\xff")
+            # Skip replies to the garbage sent ahead of the connect command.
+            data = ser.read_until(self.NXEOL)
+            while data.endswith(self.NXEOL) and not data.startswith(b"comok"):
+                data = ser.read_until(self.NXEOL)
+            if not data.startswith(b"comok ") or not data.endswith(self.NXEOL):
+                print("  {} at {}baud/s... Failed.".format(port, speed))
+                continue
+            ser.write(self.NXEOL)
+            ser.read(42)
+            return ser, speed, data
+
+        ser.close()
+        return None
 
     def sendCmd(self, cmd: str, *args):
         if not self.connected:
             raise Exception("Cannot send commands if not connected.")
 
+        cmd = str(cmd).encode("ascii")
         if args:
-            cmd = str(cmd) + " " + "{}," * len(args)
-            cmd = cmd[:-1]
-        cmd = cmd.format(*args).encode("ascii")
-        cmd += self.NXEOL
-        if self.address:
-            cmd = struct.pack("<H", self.address) + cmd
-        self.ser.write(cmd)
-
-    def ack(self):
-        a = self.ser.read_until(self.NXACK)
-        if not a.endswith(self.NXACK):
-            raise Exception("Expected acknowledge ({}), got {}.".format(self.NXACK, a))
-
-    def getFileSize(self, tftFilePath):
-        with open(tftFilePath, "rb") as f:
-            f.seek(0x3c)
-            rawSize = f.read(struct.calcsize("<I"))
-        fileSize = struct.unpack("<I", rawSize)[0]
+            cmd += b" " + b",".join(b"%d" % a if isinstance(a, int) else str(a).encode("ascii") for a in args)
+        self.ser.write(self.addressPrefix + cmd + self.NXEOL)
+
+    def ack(self, count=1):
+        # The device answers each block with exactly one NXACK byte, hence no need to scan with read_until.
+        a = self.ser.read(count)
+        if a != self.NXACK * count:
+            raise Exception("Expected acknowledge ({}), got {}.".format(self.NXACK * count, a))
+
+    def getFileSize(self, tftFile):
+        # tftFile can either be a path or the (memory mapped) content of the TFT file.
+        if isinstance(tftFile, (str, Path)):
+            with open(tftFile, "rb") as f:
+                tftFile = f.read(0x3c + struct.calcsize("<I"))
+        fileSize = struct.unpack_from("<I", tftFile, 0x3c)[0]
         return fileSize
 
     def upload(self, tftFilePath):
         if not self.connected:
             raise Exception("Successful connection required for upload.")
 
-        fileSize = self.getFileSize(tftFilePath)
+        # Slicing the memory mapped file spares us the buffered file object and lets the OS read ahead.
+        with open(tftFilePath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            fileSize = self.getFileSize(mm)
 
-        self.sendCmd("bs=42") # For some reason the first command after self.connect() always fails. Can be anything.
-        self.sendCmd("dims=100")
-        self.sendCmd("sleep=0")
-        self.ser.reset_input_buffer()
+            self.sendCmd("bs=42") # For some reason the first command after self.connect() always fails. Can be anything.
+            self.sendCmd("dims=100")
+            self.sendCmd("sleep=0")
+            self.ser.reset_input_buffer()
 
-        print("Initiating upload... ", end="")
-        self.sendCmd("whmi-wris", fileSize, self.uploadSpeed, 1)
-        self.ser.close()
-        self.ser.baudrate = self.uploadSpeed
-        self.ser.timeout  = 0.5
-        try:
-            self.ser.open()
-        except:
-            raise Exception("Cannot reopen port at upload baudrate.")
-        self.ack()
-        print("Success.")
-
-        blockSize = 4096
-        remainingBlocks = ceil(fileSize / blockSize)
-        firstBlock = True
-        progress, lastProgress = 0, 0
-        with open(tftFilePath, "rb") as f:
-            while remainingBlocks:
-                self.ser.write(f.read(blockSize))
-                remainingBlocks -= 1
-
-                if firstBlock:
-                    firstBlock = False
-                    self.ser.timeout = 2 # Apparently the processing of the first block takes closer to 1s of time.
-                    proceed = self.ser.read(len(self.NXALL))
-                    if len(proceed) != len(self.NXALL) or not proceed.startswith(b"\x08"):
-                        raise Exception("First block acknowledge (0x08) not received. Got {}.".format(proceed))
-                    elif proceed != self.NXALL:
-                        nextPos = struct.unpack_from("<I", proceed, 1)[0]
-                        f.seek(nextPos)
-                        remainingBlocks = ceil((fileSize - nextPos) / blockSize)
-                        print("Skipped ressources.")
-                    self.ser.timeout = 0.5 # return to normal timeout.
+            print("Initiating upload... ", end="")
+            self.sendCmd("whmi-wris", fileSize, self.uploadSpeed, 1)
+            # Switch the open port to the upload baudrate instead of closing and reopening it. The command must have
+            # left the port completely before, though.
+            self.ser.flush()
+            self.ser.baudrate = self.uploadSpeed
+            self.ser.timeout  = 0.5
+            self.ser.reset_input_buffer()
+            if hasattr(self.ser, "set_buffer_size"):
+                # Windows only. Let the driver buffer a whole write so it doesn't stall between blocks.
+                self.ser.set_buffer_size(rx_size=1 << 16, tx_size=max(1 << 16, self.blockSize * self.window))
+            self.ack()
+            print("Success.")
+
+            progress, lastProgress = 0, 0
+            # Terminal output is slow compared to a block at high baudrates, hence update the progress at most every
+            # 100ms. "\x1b[K" clears the rest of the line; the Windows console doesn't necessarily understand it.
+            lastPrint = time.monotonic()
+            clearLine = " " if os.name == "nt" else "\x1b[K"
+            # The first block must be exactly one protocol block since the device answers it with NXALL or the
+            # offset to continue from.
+            data = mm[:self.NXBLOCK]
+            self.ser.write(data)
+            pos = len(data)
+            inFlight = 0
+            if self.speculative and fileSize > pos:
+                # Keep the line busy while the device processes the first block by already sending the second one. If
+                # the device asks to skip ahead instead, whatever of it has been sent is expected to be ignored.
+                data = mm[pos:min(fileSize, pos + self.NXBLOCK)]
+                self.ser.write(data)
+                inFlight = 1
+            self.ser.timeout = 2 # Apparently the processing of the first block takes closer to 1s of time.
+            proceed = self.ser.read(len(self.NXALL))
+            if len(proceed) != len(self.NXALL) or not proceed.startswith(b"\x08"):
+                raise Exception("First block acknowledge (0x08) not received. Got {}.".format(proceed))
+            elif proceed != self.NXALL:
+                pos = struct.unpack_from("<I", proceed, 1)[0]
+                if inFlight:
+                    self.ser.reset_output_buffer()
+                    inFlight = 0
+                print("Skipped ressources.")
+            elif inFlight:
+                pos += len(data)
+
+            # Afterwards we write blockSize bytes at once and collect one ack per 4096 bytes. Up to self.window
+            # protocol blocks may be unacknowledged at any time so that the next write doesn't have to wait for the
+            # device to process the previous one.
+            blockSize = self.blockSize
+            # return to normal timeout, per protocol block we might have to wait for at once.
+            self.ser.timeout = 0.5 * self.window
+
+            # On Linux the kernel can copy the blocks straight from the file to the serial port. Either way a reader
+            # thread has the next blocks read from disk while the current one is being transmitted.
+            self.useSendfile = sys.platform.startswith("linux") and hasattr(self.ser, "fd")
+            blocks = queue.Queue(maxsize=8)
+            stop = threading.Event()
+            reader = threading.Thread(target=self.readBlocks,
+                                      args=(mm, pos, min(fileSize, len(mm)), blockSize, blocks, stop),
+                                      daemon=True)
+            reader.start()
+            block = False # False: next block not yet taken from the queue, None: no blocks left.
+            try:
+                while True:
+                    progress = 100 * pos // fileSize
+                    now = time.monotonic()
+                    if progress != lastProgress and (now - lastPrint >= 0.1 or progress == 100):
+                        sys.stderr.write("\r{}%{}".format(progress, clearLine))
+                        sys.stderr.flush()
+                        lastProgress, lastPrint = progress, now
+
+                    if block is False:
+                        block = blocks.get()
+                    if isinstance(block, Exception):
+                        raise block
+                    if block is None:
+                        break
+                    offset, size = block
+                    count = (size + self.NXBLOCK - 1) // self.NXBLOCK
+                    # Wait for as many acks as needed to stay within the window. Collect the acks that already arrived,
+                    # too, so the write can cover more blocks.
+                    acks = max(inFlight + count - self.window, min(self.ser.in_waiting, inFlight))
+                    if acks:
+                        self.ack(acks)
+                        inFlight -= acks
+                    # Coalesce the blocks the reader already queued into a single write as long as the window allows.
+                    while True:
+                        try:
+                            block = blocks.get_nowait()
+                        except queue.Empty:
+                            block = False
+                            break
+                        if block is None or isinstance(block, Exception):
+                            break
+                        nextCount = (block[1] + self.NXBLOCK - 1) // self.NXBLOCK
+                        if inFlight + count + nextCount > self.window:
+                            break
+                        size  += block[1]
+                        count += nextCount
+                    if self.useSendfile:
+                        self.sendFile(f, offset, size)
+                    else:
+                        self.ser.write(mm[offset:offset + size])
+                    pos = offset + size
+
+                    inFlight += count
+                if inFlight:
+                    self.ack(inFlight)
+                sys.stderr.write("\n")
+            finally:
+                stop.set()
+                reader.join()
+
+    def sendFile(self, f, offset, size):
+        while size and self.useSendfile:
+            try:
+                n = os.sendfile(self.ser.fd, f.fileno(), offset, size)
+            except BlockingIOError:
+                # pyserial opens the port non-blocking; wait until the driver accepts more data.
+                if not select.select([], [self.ser.fd], [], self.ser.write_timeout)[1]:
+                    raise serial.SerialTimeoutException("Write timeout")
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                self.useSendfile = False # Port doesn't support sendfile, use regular writes from now on.
+                break
+            if not n:
+                raise Exception("Unexpected end of file at offset {}.".format(offset))
+            offset += n
+            size   -= n
+        if size:
+            f.seek(offset)
+            self.ser.write(f.read(size))
 
+    @staticmethod
+    def readBlocks(mm, start, end, blockSize, blocks, stop):
+        # Prefetches the blocks of the given range of mm and puts their (offset, size) into the blocks queue, followed
+        # by None. If reading fails the exception is put into the queue instead so that upload() can raise it.
+        def put(item):
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for offset in range(start, end, blockSize):
+                size = min(blockSize, end - offset)
+                if hasattr(mm, "madvise"):
+                    pageStart = offset - offset % mmap.PAGESIZE
+                    mm.madvise(mmap.MADV_WILLNEED, pageStart, offset + size - pageStart)
                 else:
-                    self.ack()
-                progress = 100 * f.tell() // fileSize
-                if progress != lastProgress:
-                    print(progress, "% ", sep="", end="\r")
-                    lastProgress = progress
+                    # No madvise (e.g. Windows); touching one byte per page makes the OS read the block.
+                    for page in range(offset, offset + size, mmap.PAGESIZE):
+                        mm[page]
+                if not put((offset, size)):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
 
 
 if __name__ == "__main__":
@@ -199,6 +419,19 @@ if __name__ == "__main__":
     parser.add_argument("-u", "--upload", metavar="BAUDRATE", type=int, required=False, default=0,
                         help="Optional baudrate for the actual upload. If not specified, the baudrate at which the "
                              "connection has been established will be used for the upload, too (can be slow!).")
+    parser.add_argument("-b", "--blocksize", metavar="BYTES", type=int, required=False, default=Nexus.NXBLOCK,
+                        help="Optional number of bytes written to the screen at once during the upload. Must be a "
+                             "multiple of {0}. Larger values mean fewer writes but require the screen to buffer "
+                             "more data. Raises --window to at least BYTES/{0}. Default: {0}".format(Nexus.NXBLOCK))
+    parser.add_argument("-w", "--window", metavar="BLOCKS", type=int, required=False, default=1,
+                        help="Optional number of {}-byte blocks that may be sent before the screen acknowledged "
+                             "them. Higher values keep the line busy but the screen may drop data if its receive "
+                             "buffer overflows. Raised to at least the number of blocks per write if --blocksize "
+                             "is larger. Default: 1".format(Nexus.NXBLOCK))
+    parser.add_argument("-s", "--speculative", action="store_true",
+                        help="Send the second block while the screen is still processing the first one instead of "
+                             "waiting for its answer. Saves up to a second per upload but relies on the screen "
+                             "ignoring that block if it decides to skip unchanged ressources.")
 
     args = parser.parse_args()
     ports = [p.name for p in availablePorts()]
@@ -208,13 +441,18 @@ if __name__ == "__main__":
         print(portsStr)
         exit()
 
-    ports.append("")
-    if args.port not in ports:
+    if args.port and args.port not in ports:
         parser.error("Port {} not found among the available ports: {}.".format(args.port, portsStr))
 
     tftPath = Path(args.input)
     if not tftPath.exists():
         parser.error("Invalid source file!")
 
-    nxu = Nexus(port=args.port, connectSpeed=args.connect, uploadSpeed=args.upload)
+    if args.blocksize <= 0 or args.blocksize % Nexus.NXBLOCK:
+        parser.error("Block size must be a positive multiple of {}.".format(Nexus.NXBLOCK))
+    if args.window < 1:
+        parser.error("Window must be at least 1.")
+
+    nxu = Nexus(port=args.port, connectSpeed=args.connect, uploadSpeed=args.upload, blockSize=args.blocksize,
+                window=args.window, ports=ports, speculative=args.speculative)
     nxu.upload(tftPath)